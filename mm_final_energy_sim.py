@@ -1,339 +1,623 @@
-# =========================================
-# file: mm_final_energy_sim.py
-# (unchanged logic; only the alias added at bottom)
-# =========================================
-from __future__ import annotations
-
-import csv
-import io
-import os
-import re
-import shutil
-import sqlite3
-import subprocess
-import sys
-import tempfile
-from typing import Dict, Iterable, List, Optional, Tuple
-
-import boto3
-from botocore.exceptions import ClientError
-from openpyxl import Workbook, load_workbook
-from openpyxl.utils import get_column_letter
-
-S3_ENDPOINT = os.environ.get("S3_ENDPOINT", "http://minio:9000")
-S3_ACCESS_KEY = os.environ.get("S3_ACCESS_KEY", "minioadmin")
-S3_SECRET_KEY = os.environ.get("S3_SECRET_KEY", "minioadmin")
-S3_BUCKET = os.environ.get("S3_BUCKET", "mmstore")
-
-S3_IDF_PREFIX = os.environ.get("S3_IDF_PREFIX", "output_idf_files/")
-S3_EPW_PREFIX = os.environ.get("S3_EPW_PREFIX", "weather/epw/")
-
-TOTAL_XLSX_KEY = "results_total_site_energy.xlsx"
-PERAREA_XLSX_KEY = "results_site_energy_per_area.xlsx"
-
-ENERGYPLUS_EXE = os.environ.get("ENERGYPLUS_EXE", "energyplus")
-TIMEOUT_SEC = int(os.environ.get("RUN_TIMEOUT_SEC", "3600"))
-KEEP_OUTPUTS = os.environ.get("KEEP_OUTPUTS", "false").lower() in ("1", "true", "yes")
-
-YEARS_START = 2025
-YEARS_END = 2084
-
-IDF_NAME_RE = re.compile(
-    r"^(RCP(?:8\.5|4\.5|2\.6))_([EFT](?:[12]?\d|2[0-8]))_(20[2-7]\d|208[0-4])\.idf$",
-    re.IGNORECASE,
-)
-EPW_NAME_RE = re.compile(
-    r"^Rotterdam_(RCP(?:85|45|26))_(20[2-7]\d|208[0-4])\.epw$",
-    re.IGNORECASE,
-)
-
-def map_rcp_dot_to_nodot(rcp: str) -> str:
-    rcp = rcp.upper().replace(" ", "")
-    return rcp.replace("8.5", "85").replace("4.5", "45").replace("2.6", "26")
-
-def parse_idf_filename(name: str) -> Tuple[str, str, int]:
-    m = IDF_NAME_RE.match(name)
-    if not m:
-        raise ValueError(f"Unrecognized IDF filename: {name}")
-    rcp_dot, aging, year_str = m.groups()
-    return rcp_dot.upper(), aging.upper(), int(year_str)
-
-def s3_client():
-    return boto3.client(
-        "s3",
-        endpoint_url=S3_ENDPOINT,
-        aws_access_key_id=S3_ACCESS_KEY,
-        aws_secret_access_key=S3_SECRET_KEY,
-    )
-
-def _list_objects_all(c, bucket: str, prefix: str) -> Iterable[dict]:
-    token = None
-    while True:
-        kwargs = {"Bucket": bucket, "Prefix": prefix}
-        if token:
-            kwargs["ContinuationToken"] = token
-        resp = c.list_objects_v2(**kwargs)
-        for obj in resp.get("Contents", []) or []:
-            yield obj
-        if not resp.get("IsTruncated"):
-            break
-        token = resp.get("NextContinuationToken")
-
-def object_exists(c, bucket: str, key: str) -> bool:
-    try:
-        c.head_object(Bucket=bucket, Key=key)
-        return True
-    except ClientError as e:
-        code = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
-        if code in (403, 404):
-            return False
-        raise
-
-def download_to_file(c, bucket: str, key: str, local_path: str) -> None:
-    os.makedirs(os.path.dirname(local_path), exist_ok=True)
-    c.download_file(bucket, key, local_path)
-
-def upload_bytes(c, bucket: str, key: str, data: bytes) -> None:
-    c.put_object(Bucket=bucket, Key=key, Body=data)
-
-def index_epws_s3(c, bucket: str, epw_prefix: str) -> Dict[Tuple[str, int], str]:
-    idx: Dict[Tuple[str, int], str] = {}
-    for obj in _list_objects_all(c, bucket, epw_prefix):
-        key = obj["Key"]
-        name = key.rsplit("/", 1)[-1]
-        m = EPW_NAME_RE.match(name)
-        if not m:
-            continue
-        rcp_nodot, year_str = m.groups()
-        idx[(rcp_nodot.upper(), int(year_str))] = key
-    return idx
-
-def run_energyplus(idf_path: str, epw_path: str, outdir: str) -> None:
-    cmd = [
-        ENERGYPLUS_EXE,
-        "--weather", epw_path,
-        "--output-directory", outdir,
-        "--readvars", "--expandobjects",
-        idf_path,
-    ]
-    proc = subprocess.run(
-        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=TIMEOUT_SEC
-    )
-    if proc.returncode != 0:
-        raise RuntimeError(
-            f"EnergyPlus failed ({proc.returncode}) for:\n  {os.path.basename(idf_path)}\nSTDOUT:\n{proc.stdout}\nSTDERR:\n{proc.stderr}"
-        )
-
-def _safe_float(s: str) -> Optional[float]:
-    try:
-        return float(str(s).replace(",", "").strip())
-    except Exception:
-        return None
-
-def fetch_from_sql(sql_path: str) -> Tuple[Optional[float], Optional[float]]:
-    if not os.path.exists(sql_path):
-        return None, None
-    con = sqlite3.connect(sql_path)
-    cur = con.cursor()
-    try:
-        cur.execute(
-            """
-            SELECT Value
-            FROM TabularDataWithStrings
-            WHERE lower(TableName) LIKE 'site and source energy%%'
-              AND lower(RowName) = 'total site energy'
-              AND lower(ColumnName) LIKE 'total energy%%'
-            """
-        )
-        row = cur.fetchone()
-        total_site = _safe_float(row[0]) if row else None
-
-        cur.execute(
-            """
-            SELECT Value
-            FROM TabularDataWithStrings
-            WHERE lower(TableName) LIKE 'site and source energy%%'
-              AND lower(RowName) = 'total site energy'
-              AND lower(ColumnName) LIKE 'energy per total building area%%'
-            """
-        )
-        row = cur.fetchone()
-        per_area = _safe_float(row[0]) if row else None
-        return total_site, per_area
-    finally:
-        con.close()
-
-def _fetch_from_tabular_text(path: str, delimiter: str) -> Tuple[Optional[float], Optional[float]]:
-    if not os.path.exists(path):
-        return None, None
-    with open(path, "r", encoding="utf-8", errors="ignore") as f:
-        rows: List[List[str]] = [[c.strip() for c in r] for r in csv.reader(f, delimiter=delimiter)]
-    for i, r in enumerate(rows):
-        if any("annual building utility performance summary" in c.lower() for c in r):
-            for j in range(i + 1, min(i + 40, len(rows))):
-                if any("site and source energy" in c.lower() for c in rows[j]):
-                    header_idx = None
-                    for k in range(j + 1, min(j + 15, len(rows))):
-                        hdr_lower = [c.lower() for c in rows[k]]
-                        if any("total energy" in c for c in hdr_lower) and any(
-                            "energy per total building area" in c for c in hdr_lower
-                        ):
-                            header_idx = k
-                            break
-                    if header_idx is None:
-                        continue
-                    header = [h.lower() for h in rows[header_idx]]
-                    try:
-                        col_total = next(i2 for i2, c in enumerate(header) if "total energy" in c)
-                        col_per_area = next(i2 for i2, c in enumerate(header) if "energy per total building area" in c)
-                    except StopIteration:
-                        continue
-                    for r2 in rows[header_idx + 1 :]:
-                        if not r2 or all(c == "" for c in r2):
-                            break
-                        if r2[0].strip().lower() == "total site energy":
-                            total_site = _safe_float(r2[col_total]) if col_total < len(r2) else None
-                            per_area = _safe_float(r2[col_per_area]) if col_per_area < len(r2) else None
-                            return total_site, per_area
-    return None, None
-
-def fetch_metrics_any(outdir: str) -> Tuple[Optional[float], Optional[float], str]:
-    sql_path = os.path.join(outdir, "eplusout.sql")
-    if os.path.exists(sql_path):
-        t, p = fetch_from_sql(sql_path)
-        if t is not None or p is not None:
-            return t, p, "sql"
-    tab_path = os.path.join(outdir, "eplustbl.tab")
-    t, p = _fetch_from_tabular_text(tab_path, "\t")
-    if t is not None or p is not None:
-        return t, p, "tab"
-    csv_path = os.path.join(outdir, "eplustbl.csv")
-    t, p = _fetch_from_tabular_text(csv_path, ",")
-    if t is not None or p is not None:
-        return t, p, "csv"
-    return None, None, "none"
-
-def _init_workbook() -> Workbook:
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Results"
-    ws["A1"] = "Year"; ws["A2"] = ""
-    for i, year in enumerate(range(YEARS_START, YEARS_END + 1), start=3):
-        ws.cell(row=i, column=1, value=year)
-    return wb
-
-def _download_workbook_or_create(c, bucket: str, key: str) -> Workbook:
-    if object_exists(c, bucket, key):
-        obj = c.get_object(Bucket=bucket, Key=key)
-        data = obj["Body"].read()
-        return load_workbook(io.BytesIO(data))
-    return _init_workbook()
-
-def _upload_workbook(c, bucket: str, key: str, wb: Workbook) -> None:
-    buf = io.BytesIO()
-    wb.save(buf)
-    buf.seek(0)
-    upload_bytes(c, bucket, key, buf.read())
-
-def _col_for_pair(ws, climate: str, aging: str) -> int:
-    max_col = ws.max_column or 1
-    for col in range(2, max_col + 1):
-        c1 = (ws.cell(row=1, column=col).value or "").strip()
-        c2 = (ws.cell(row=2, column=col).value or "").strip()
-        if c1 == climate and c2 == aging:
-            return col
-    col = max_col + 1 if max_col >= 2 else 2
-    ws.cell(row=1, column=col, value=climate)
-    ws.cell(row=2, column=col, value=aging)
-    ws.column_dimensions[get_column_letter(col)].width = 16
-    return col
-
-def _row_for_year(year: int) -> int:
-    if year < YEARS_START or year > YEARS_END:
-        raise ValueError(f"Year {year} outside [{YEARS_START}, {YEARS_END}]")
-    return 3 + (year - YEARS_START)
-
-def write_result_to_s3(c, bucket: str, key: str, climate: str, aging: str, year: int, value: Optional[float]) -> None:
-    if value is None:
-        return  # why: match original behavior; don't write zeros
-    wb = _download_workbook_or_create(c, bucket, key)
-    ws = wb.active
-    col = _col_for_pair(ws, climate, aging)
-    row = _row_for_year(year)
-    ws.cell(row=row, column=col, value=value)
-    _upload_workbook(c, bucket, key, wb)
-    wb.close()
-
-def run_energy_simulation_from_env() -> Dict[str, object]:
-    c = s3_client()
-    epw_index = index_epws_s3(c, S3_BUCKET, S3_EPW_PREFIX)
-    if not epw_index:
-        raise SystemExit(f"No EPWs under s3://{S3_BUCKET}/{S3_EPW_PREFIX}")
-
-    idf_objs = [o for o in _list_objects_all(c, S3_BUCKET, S3_IDF_PREFIX) if o["Key"].lower().endswith(".idf")]
-    if not idf_objs:
-        raise SystemExit(f"No IDFs under s3://{S3_BUCKET}/{S3_IDF_PREFIX}")
-
-    successes = failures = 0
-    processed: List[str] = []
-
-    for i, obj in enumerate(sorted(idf_objs, key=lambda x: x["Key"]), start=1):
-        idf_key = obj["Key"]
-        name = idf_key.rsplit("/", 1)[-1]
-        run_dir = None
-        try:
-            rcp_dot, aging, year = parse_idf_filename(name)
-            rcp_nodot = map_rcp_dot_to_nodot(rcp_dot)
-            epw_key = epw_index.get((rcp_nodot, year))
-            if not epw_key:
-                print(f"[WARN] No EPW for {name} → ({rcp_nodot}, {year}); skipping.")
-                failures += 1
-                continue
-
-            run_dir = tempfile.mkdtemp(prefix="eplus_run_")
-            idf_path = os.path.join(run_dir, name)
-            epw_name = epw_key.rsplit("/", 1)[-1]
-            epw_path = os.path.join(run_dir, epw_name)
-
-            download_to_file(c, S3_BUCKET, idf_key, idf_path)
-            download_to_file(c, S3_BUCKET, epw_key, epw_path)
-
-            print(f"[{i}/{len(idf_objs)}] {name} × {epw_name}")
-            run_energyplus(idf_path, epw_path, run_dir)
-
-            total_site, per_area, src = fetch_metrics_any(run_dir)
-            if total_site is None and per_area is None:
-                raise RuntimeError("Failed to extract metrics; ensure ABUPS tables are produced.")
-
-            write_result_to_s3(c, S3_BUCKET, TOTAL_XLSX_KEY, rcp_nodot, aging, year, total_site)
-            write_result_to_s3(c, S3_BUCKET, PERAREA_XLSX_KEY, rcp_nodot, aging, year, per_area)
-
-            successes += 1
-            processed.append(idf_key)
-            print(f"    -> OK (src={src}, total_site={total_site}, per_area={per_area})")
-        except Exception as e:
-            failures += 1
-            print(f"[ERROR] {name}: {e}")
-        finally:
-            if run_dir and os.path.isdir(run_dir) and not KEEP_OUTPUTS:
-                shutil.rmtree(run_dir, ignore_errors=True)
-
-    return {
-        "bucket": S3_BUCKET,
-        "idf_prefix": S3_IDF_PREFIX.rstrip("/"),
-        "epw_prefix": S3_EPW_PREFIX.rstrip("/"),
-        "results_total_key": TOTAL_XLSX_KEY,
-        "results_per_area_key": PERAREA_XLSX_KEY,
-        "processed": processed[:10],
-        "counts": {"success": successes, "failed": failures, "total": len(idf_objs)},
-    }
-
-def main() -> None:
-    print(run_energy_simulation_from_env())
-
-if __name__ == "__main__":
-    main()
-
-# ---------- compatibility alias (fix for adapter name mismatch) ----------
-# Why: some adapters call this legacy name; keep both without duplicating logic.
-run_energy_model_from_env = run_energy_simulation_from_env
+# =========================================
+# file: mm_final_energy_sim.py
+# =========================================
+from __future__ import annotations
+
+import csv
+import io
+import os
+import re
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from openpyxl import Workbook, load_workbook
+from openpyxl.utils import get_column_letter
+
+S3_ENDPOINT = os.environ.get("S3_ENDPOINT", "http://minio:9000")
+S3_ACCESS_KEY = os.environ.get("S3_ACCESS_KEY", "minioadmin")
+S3_SECRET_KEY = os.environ.get("S3_SECRET_KEY", "minioadmin")
+S3_BUCKET = os.environ.get("S3_BUCKET", "mmstore")
+
+S3_IDF_PREFIX = os.environ.get("S3_IDF_PREFIX", "output_idf_files/")
+S3_EPW_PREFIX = os.environ.get("S3_EPW_PREFIX", "weather/epw/")
+
+RESULTS_PREFIX = "results_"
+TOTAL_CSV_KEY = "results_total_site_energy.csv"
+PERAREA_CSV_KEY = "results_site_energy_per_area.csv"
+# XLSX twins of the CSV keys: seeded from on first run after the CSV switch,
+# and rewritten at flush so clients fetching these keys keep working.
+TOTAL_XLSX_KEY = "results_total_site_energy.xlsx"
+PERAREA_XLSX_KEY = "results_site_energy_per_area.xlsx"
+_XLSX_KEY_FOR = {TOTAL_CSV_KEY: TOTAL_XLSX_KEY, PERAREA_CSV_KEY: PERAREA_XLSX_KEY}
+
+ENERGYPLUS_EXE = os.environ.get("ENERGYPLUS_EXE", "energyplus")
+TIMEOUT_SEC = int(os.environ.get("RUN_TIMEOUT_SEC", "3600"))
+KEEP_OUTPUTS = os.environ.get("KEEP_OUTPUTS", "false").lower() in ("1", "true", "yes")
+SIM_WORKERS = int(os.environ.get("SIM_WORKERS", str(os.cpu_count() or 1)))
+EPLUS_TMPFS = os.environ.get("EPLUS_TMPFS", "1").lower() in ("1", "true", "yes")
+EPLUS_TMPFS_MIN_FREE_MB = int(os.environ.get("EPLUS_TMPFS_MIN_FREE_MB", "512"))
+
+YEARS_START = 2025
+YEARS_END = 2084
+
+IDF_NAME_RE = re.compile(
+    r"^(RCP(?:8\.5|4\.5|2\.6))_([EFT](?:[12]?\d|2[0-8]))_(20[2-7]\d|208[0-4])\.idf$",
+    re.IGNORECASE,
+)
+EPW_NAME_RE = re.compile(
+    r"^Rotterdam_(RCP(?:85|45|26))_(20[2-7]\d|208[0-4])\.epw$",
+    re.IGNORECASE,
+)
+
+def map_rcp_dot_to_nodot(rcp: str) -> str:
+    rcp = rcp.upper().replace(" ", "")
+    return rcp.replace("8.5", "85").replace("4.5", "45").replace("2.6", "26")
+
+def parse_idf_filename(name: str) -> Tuple[str, str, int]:
+    # Cheap prefix reject before paying for the regex; most non-IDF keys in
+    # a busy bucket fail here. Only the first three chars are uppercased so
+    # the reject never copies the whole name.
+    if name[:3].upper() != "RCP":
+        raise ValueError(f"Unrecognized IDF filename: {name}")
+    m = IDF_NAME_RE.match(name)
+    if not m:
+        raise ValueError(f"Unrecognized IDF filename: {name}")
+    rcp_dot, aging, year_str = m.groups()
+    return rcp_dot.upper(), aging.upper(), int(year_str)
+
+_EPW_RCPS = ("RCP85", "RCP45", "RCP26")
+
+def _parse_epw_name(name: str) -> Optional[Tuple[str, int]]:
+    # The EPW layout is fully fixed (Rotterdam_RCP{XX}_{YEAR}.epw), so a
+    # split-based parse beats the regex by a wide margin; the regex stays as
+    # the validator for anything that deviates from the fast path.
+    low = name.lower()
+    if not low.startswith("rotterdam_rcp") or not low.endswith(".epw"):
+        return None
+    parts = name[:-4].split("_")
+    if len(parts) == 3 and parts[2].isdigit():
+        rcp = parts[1].upper()
+        year = int(parts[2])
+        if rcp in _EPW_RCPS and 2020 <= year <= 2084:
+            return rcp, year
+    m = EPW_NAME_RE.match(name)
+    if not m:
+        return None
+    rcp_nodot, year_str = m.groups()
+    return rcp_nodot.upper(), int(year_str)
+
+def _key_basename(key: str) -> str:
+    # rfind+slice allocates only the final segment, unlike rsplit's list.
+    return key[key.rfind("/") + 1:]
+
+def _cfg(config: Optional[Dict[str, str]], key: str, default: str) -> str:
+    # Per-run overrides come in via config; the module-level constants (which
+    # already captured os.environ at import) stay the fallback. This keeps
+    # concurrent runs from having to mutate the process-global environment.
+    if config and key in config:
+        return config[key]
+    return default
+
+def s3_client(config: Optional[Dict[str, str]] = None):
+    return boto3.client(
+        "s3",
+        endpoint_url=_cfg(config, "S3_ENDPOINT", S3_ENDPOINT),
+        aws_access_key_id=_cfg(config, "S3_ACCESS_KEY", S3_ACCESS_KEY),
+        aws_secret_access_key=_cfg(config, "S3_SECRET_KEY", S3_SECRET_KEY),
+    )
+
+def _norm_prefix(prefix: str) -> str:
+    # A trailing "/" lets S3 implementations (MinIO included) prune the
+    # listing to the exact "directory" instead of scanning all siblings.
+    return prefix.rstrip("/") + "/" if prefix else prefix
+
+def _list_objects_all(c, bucket: str, prefix: str) -> Iterable[dict]:
+    paginator = c.get_paginator("list_objects_v2")
+    pages = paginator.paginate(Bucket=bucket, Prefix=prefix, PaginationConfig={"PageSize": 1000})
+    for obj in pages.search("Contents[]"):
+        if obj is not None:
+            yield obj
+
+# Multi-range parallel transfers; EPWs are often >10 MB so ranged GETs overlap.
+_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=5 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=8,
+    use_threads=True,
+)
+
+def download_to_file(c, bucket: str, key: str, local_path: str) -> None:
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    c.download_file(bucket, key, local_path, Config=_TRANSFER_CONFIG)
+
+def upload_bytes(c, bucket: str, key: str, data) -> None:
+    # Accepts bytes or a seekable file-like; file-likes stream straight into
+    # the transfer manager (parallel multipart above the threshold) without
+    # materializing a second copy of the payload.
+    if isinstance(data, (bytes, bytearray)):
+        data = io.BytesIO(data)
+    c.upload_fileobj(data, bucket, key, Config=_TRANSFER_CONFIG)
+
+def index_epws_s3(c, bucket: str, epw_prefix: str) -> Dict[Tuple[str, int], str]:
+    idx: Dict[Tuple[str, int], str] = {}
+    for obj in _list_objects_all(c, bucket, _norm_prefix(epw_prefix)):
+        key = obj["Key"]
+        name = _key_basename(key)
+        parsed = _parse_epw_name(name)
+        if parsed is None:
+            continue
+        idx[parsed] = key
+    return idx
+
+def run_energyplus(idf_path: str, epw_path: str, outdir: str) -> None:
+    cmd = [
+        ENERGYPLUS_EXE,
+        "--weather", epw_path,
+        "--output-directory", outdir,
+        "--readvars", "--expandobjects",
+        idf_path,
+    ]
+    # stdout is discarded (it is only useful interactively); stderr is drained
+    # into a bounded ring buffer by a thread so a full pipe can never block
+    # the child. start_new_session puts EnergyPlus and its helper children
+    # (ExpandObjects, ReadVarsESO) in one process group we can kill together.
+    proc = subprocess.Popen(
+        cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, start_new_session=True
+    )
+    stderr_tail: deque = deque(maxlen=4096)
+
+    def _drain() -> None:
+        assert proc.stderr is not None
+        for raw in proc.stderr:
+            stderr_tail.append(raw)
+        proc.stderr.close()
+
+    drainer = threading.Thread(target=_drain, daemon=True)
+    drainer.start()
+    try:
+        rc = proc.wait(timeout=TIMEOUT_SEC)
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(os.getpgid(proc.pid), signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            proc.kill()
+        proc.wait()
+        drainer.join()
+        raise
+    drainer.join()
+    if rc != 0:
+        tail = b"".join(stderr_tail).decode("utf-8", errors="replace")
+        raise RuntimeError(
+            f"EnergyPlus failed ({rc}) for:\n  {os.path.basename(idf_path)}\nSTDERR (tail):\n{tail}"
+        )
+
+def _safe_float(s: str) -> Optional[float]:
+    try:
+        return float(str(s).replace(",", "").strip())
+    except Exception:
+        return None
+
+# One parameterized statement, built once per process. sqlite3's statement
+# cache is per-connection and every eplusout.sql gets a fresh connection, so
+# nothing is re-prepared across files; the constant avoids rebuilding the SQL
+# text per call and keeps the LIKE patterns in one place.
+_SQL_SITE_ENERGY = """
+    SELECT lower(ColumnName), Value
+    FROM TabularDataWithStrings
+    WHERE lower(TableName) LIKE ?
+      AND lower(RowName) = ?
+      AND (lower(ColumnName) LIKE ? OR lower(ColumnName) LIKE ?)
+"""
+_SQL_SITE_ENERGY_PARAMS = (
+    "site and source energy%",
+    "total site energy",
+    "total energy%",
+    "energy per total building area%",
+)
+
+def fetch_from_sql(sql_path: str) -> Tuple[Optional[float], Optional[float]]:
+    # mode=ro&immutable=1: the EnergyPlus output file never changes once the
+    # run finishes, so SQLite can skip locking/WAL checks and cache freely.
+    con = sqlite3.connect(f"file:{sql_path}?mode=ro&immutable=1", uri=True)
+    cur = con.cursor()
+    try:
+        cur.execute("PRAGMA query_only=ON")
+        cur.execute("PRAGMA temp_store=MEMORY")
+        cur.execute("PRAGMA cache_size=-20000")
+        cur.execute("PRAGMA mmap_size=134217728")
+        cur.execute(_SQL_SITE_ENERGY, _SQL_SITE_ENERGY_PARAMS)
+        total_site = per_area = None
+        for col_name, value in cur.fetchall():
+            if col_name.startswith("total energy"):
+                if total_site is None:
+                    total_site = _safe_float(value)
+            elif per_area is None:
+                per_area = _safe_float(value)
+        return total_site, per_area
+    finally:
+        con.close()
+
+# Target phrases for the ABUPS tabular scan, lowercased once at import.
+_ABUPS_MARKER = "annual building utility performance summary"
+_SITE_SOURCE_MARKER = "site and source energy"
+_TOTAL_ENERGY_HDR = "total energy"
+_PER_AREA_HDR = "energy per total building area"
+_TOTAL_SITE_ROW = "total site energy"
+
+def _fetch_from_tabular_text(path: str, delimiter: str) -> Tuple[Optional[float], Optional[float]]:
+    # Single streaming pass instead of materializing the whole file as a
+    # List[List[str]]: a small state machine walks ABUPS -> Site and Source
+    # Energy -> header -> Total Site Energy and exits on the first hit.
+    # Each line is lowercased once and matched with substring tests; rows
+    # are only split when a candidate line is found. EnergyPlus tabular
+    # output has no quoted fields, so a plain split replaces csv.reader.
+    # Lookahead windows (40 rows to the table, 15 to the header) match the
+    # old slicing bounds.
+    SEEK_ABUPS, SEEK_TABLE, SEEK_HEADER, SEEK_ROW = range(4)
+    state = SEEK_ABUPS
+    table_window = header_window = 0
+    col_total = col_per_area = -1
+    blank_chars = delimiter + " \r\n"
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            low = line.lower()
+            if state == SEEK_ABUPS:
+                if _ABUPS_MARKER in low:
+                    state = SEEK_TABLE
+                    table_window = 40
+            elif state == SEEK_TABLE:
+                table_window -= 1
+                if _SITE_SOURCE_MARKER in low:
+                    state = SEEK_HEADER
+                    header_window = 15
+                elif table_window <= 0:
+                    state = SEEK_ABUPS
+            elif state == SEEK_HEADER:
+                table_window -= 1
+                header_window -= 1
+                if low.find(_TOTAL_ENERGY_HDR) != -1 and low.find(_PER_AREA_HDR) != -1:
+                    cells = [c.strip() for c in low.rstrip("\r\n").split(delimiter)]
+                    col_total = next(i for i, c in enumerate(cells) if _TOTAL_ENERGY_HDR in c)
+                    col_per_area = next(i for i, c in enumerate(cells) if _PER_AREA_HDR in c)
+                    state = SEEK_ROW
+                elif header_window <= 0:
+                    state = SEEK_TABLE if table_window > 0 else SEEK_ABUPS
+            elif state == SEEK_ROW:
+                table_window -= 1
+                if not low.strip(blank_chars):
+                    state = SEEK_TABLE if table_window > 0 else SEEK_ABUPS
+                elif low.split(delimiter, 1)[0].strip() == _TOTAL_SITE_ROW:
+                    cells = [c.strip() for c in line.rstrip("\r\n").split(delimiter)]
+                    total_site = _safe_float(cells[col_total]) if col_total < len(cells) else None
+                    per_area = _safe_float(cells[col_per_area]) if col_per_area < len(cells) else None
+                    return total_site, per_area
+    return None, None
+
+def fetch_metrics_any(outdir: str) -> Tuple[Optional[float], Optional[float], str]:
+    # One scandir replaces a stat per candidate file; after a run only one
+    # of the three outputs typically exists.
+    with os.scandir(outdir) as it:
+        names = {e.name for e in it if e.is_file()}
+    if "eplusout.sql" in names:
+        t, p = fetch_from_sql(os.path.join(outdir, "eplusout.sql"))
+        if t is not None or p is not None:
+            return t, p, "sql"
+    if "eplustbl.tab" in names:
+        t, p = _fetch_from_tabular_text(os.path.join(outdir, "eplustbl.tab"), "\t")
+        if t is not None or p is not None:
+            return t, p, "tab"
+    if "eplustbl.csv" in names:
+        t, p = _fetch_from_tabular_text(os.path.join(outdir, "eplustbl.csv"), ",")
+        if t is not None or p is not None:
+            return t, p, "csv"
+    return None, None, "none"
+
+# Authoritative in-run representation of a results table:
+# (climate, aging) -> {year -> value}. The hot path only ever touches these
+# dicts; CSV is the storage format and XLSX is materialized on demand.
+_ResultMatrix = Dict[Tuple[str, str], Dict[int, float]]
+
+# S3 key -> (matrix, dirty). Matrices are fetched at most once per run and
+# mutated in memory; _flush_cache serializes each dirty one a single time.
+_MatrixCache = Dict[str, Tuple[_ResultMatrix, bool]]
+
+def _matrix_from_csv(text: str) -> _ResultMatrix:
+    # Layout mirrors the XLSX presentation: row 1 climates, row 2 agings,
+    # column A years.
+    rows = list(csv.reader(io.StringIO(text)))
+    matrix: _ResultMatrix = {}
+    if len(rows) < 2:
+        return matrix
+    climates, agings = rows[0], rows[1]
+    pairs = [
+        (col, climates[col].strip(), agings[col].strip() if col < len(agings) else "")
+        for col in range(1, len(climates))
+        if climates[col].strip()
+    ]
+    for row in rows[2:]:
+        if not row or not row[0].strip().isdigit():
+            continue
+        year = int(row[0])
+        for col, climate, aging in pairs:
+            if col < len(row):
+                v = _safe_float(row[col])
+                if v is not None:
+                    matrix.setdefault((climate, aging), {})[year] = v
+    return matrix
+
+def _matrix_to_csv_bytes(matrix: _ResultMatrix) -> bytes:
+    pairs = sorted(matrix)
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow(["Year"] + [p[0] for p in pairs])
+    w.writerow([""] + [p[1] for p in pairs])
+    for year in range(YEARS_START, YEARS_END + 1):
+        w.writerow([year] + [matrix[p].get(year, "") for p in pairs])
+    return buf.getvalue().encode("utf-8")
+
+def matrix_to_xlsx_bytes(matrix: _ResultMatrix) -> bytes:
+    # Presentation path only, invoked when a client asks for XLSX; the
+    # write-only workbook streams rows without a cell object graph.
+    pairs = sorted(matrix)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title="Results")
+    for i in range(len(pairs)):
+        ws.column_dimensions[get_column_letter(i + 2)].width = 16
+    ws.append(["Year"] + [p[0] for p in pairs])
+    ws.append([""] + [p[1] for p in pairs])
+    for year in range(YEARS_START, YEARS_END + 1):
+        ws.append([year] + [matrix[p].get(year) for p in pairs])
+    buf = io.BytesIO()
+    wb.save(buf)
+    wb.close()
+    return buf.getvalue()
+
+def results_xlsx_bytes(c, bucket: str, csv_key: str) -> Optional[bytes]:
+    # On-demand XLSX for the adapter's results endpoint; None if the CSV
+    # does not exist yet.
+    try:
+        obj = c.get_object(Bucket=bucket, Key=csv_key)
+    except c.exceptions.NoSuchKey:
+        return None
+    return matrix_to_xlsx_bytes(_matrix_from_csv(obj["Body"].read().decode("utf-8")))
+
+def _matrix_from_xlsx(data: bytes) -> _ResultMatrix:
+    # Migration reader for workbooks written before the CSV switch; same
+    # layout (climate/aging header rows, year column).
+    wb = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    ws = wb.active
+    matrix: _ResultMatrix = {}
+    rows = ws.iter_rows(values_only=True)
+    climates = next(rows, None) or ()
+    agings = next(rows, None) or ()
+    pairs = [
+        (col, str(climates[col]).strip(), str(agings[col]).strip() if col < len(agings) and agings[col] is not None else "")
+        for col in range(1, len(climates))
+        if climates[col] is not None and str(climates[col]).strip()
+    ]
+    for row in rows:
+        if not row or not isinstance(row[0], int):
+            continue
+        year = row[0]
+        for col, climate, aging in pairs:
+            if col < len(row):
+                v = _safe_float(row[col]) if row[col] is not None else None
+                if v is not None:
+                    matrix.setdefault((climate, aging), {})[year] = v
+    wb.close()
+    return matrix
+
+def _download_matrix_or_create(c, bucket: str, key: str, existing_keys: set) -> _ResultMatrix:
+    # Membership in existing_keys replaces a per-call HEAD; the set is built
+    # from a single RESULTS_PREFIX listing at the start of the run.
+    if key in existing_keys:
+        obj = c.get_object(Bucket=bucket, Key=key)
+        return _matrix_from_csv(obj["Body"].read().decode("utf-8"))
+    # No CSV yet: seed from the pre-switch XLSX so accumulated results
+    # survive the format migration.
+    legacy_key = _XLSX_KEY_FOR.get(key)
+    if legacy_key and legacy_key in existing_keys:
+        obj = c.get_object(Bucket=bucket, Key=legacy_key)
+        return _matrix_from_xlsx(obj["Body"].read())
+    return {}
+
+def _stage_result(
+    c,
+    cache: _MatrixCache,
+    existing_keys: set,
+    bucket: str,
+    key: str,
+    climate: str,
+    aging: str,
+    year: int,
+    value: Optional[float],
+) -> None:
+    if value is None:
+        return  # why: match original behavior; don't write zeros
+    if year < YEARS_START or year > YEARS_END:
+        raise ValueError(f"Year {year} outside [{YEARS_START}, {YEARS_END}]")
+    entry = cache.get(key)
+    matrix = entry[0] if entry else _download_matrix_or_create(c, bucket, key, existing_keys)
+    matrix.setdefault((climate, aging), {})[year] = value
+    cache[key] = (matrix, True)
+
+def _flush_cache(c, bucket: str, cache: _MatrixCache) -> None:
+    for key, (matrix, dirty) in cache.items():
+        if dirty:
+            upload_bytes(c, bucket, key, _matrix_to_csv_bytes(matrix))
+            # Keep the XLSX twin current for clients that fetch it from the
+            # bucket directly; one streamed serialization per run, not per
+            # result, so the hot path stays openpyxl-free.
+            xlsx_key = _XLSX_KEY_FOR.get(key)
+            if xlsx_key:
+                upload_bytes(c, bucket, xlsx_key, matrix_to_xlsx_bytes(matrix))
+    cache.clear()
+
+# Per-worker S3 client; built once in the pool initializer so each worker
+# reuses a single boto3 client instead of rebuilding it per job.
+_WORKER_CLIENT = None
+
+def _worker_init(config: Optional[Dict[str, str]] = None) -> None:
+    global _WORKER_CLIENT
+    _WORKER_CLIENT = s3_client(config)
+
+def _make_run_dir() -> str:
+    # Inputs and EnergyPlus outputs are transient, so keep them on a RAM
+    # backed tmpfs when enough of it is free; disk stays the fallback.
+    if EPLUS_TMPFS and os.path.isdir("/dev/shm"):
+        try:
+            free = shutil.disk_usage("/dev/shm").free
+            if free >= EPLUS_TMPFS_MIN_FREE_MB * 1024 * 1024:
+                return tempfile.mkdtemp(prefix="eplus_run_", dir="/dev/shm")
+        except OSError:
+            pass
+    return tempfile.mkdtemp(prefix="eplus_run_")
+
+def _process_one(bucket: str, idf_key: str, epw_key: str, idx: int, total: int) -> Tuple[str, Optional[float], Optional[float], Optional[str]]:
+    c = _WORKER_CLIENT or s3_client()
+    name = _key_basename(idf_key)
+    run_dir = None
+    try:
+        run_dir = _make_run_dir()
+        idf_path = os.path.join(run_dir, name)
+        epw_name = _key_basename(epw_key)
+        epw_path = os.path.join(run_dir, epw_name)
+
+        # Both fetches are independent I/O; overlap them instead of stacking
+        # their latency into the critical path.
+        with ThreadPoolExecutor(max_workers=2) as dl:
+            futs = [
+                dl.submit(download_to_file, c, bucket, idf_key, idf_path),
+                dl.submit(download_to_file, c, bucket, epw_key, epw_path),
+            ]
+            for f in futs:
+                f.result()
+
+        print(f"[{idx}/{total}] {name} × {epw_name}")
+        run_energyplus(idf_path, epw_path, run_dir)
+
+        total_site, per_area, src = fetch_metrics_any(run_dir)
+        if total_site is None and per_area is None:
+            raise RuntimeError("Failed to extract metrics; ensure ABUPS tables are produced.")
+        print(f"    -> OK (src={src}, total_site={total_site}, per_area={per_area})")
+        return idf_key, total_site, per_area, None
+    except Exception as e:
+        return idf_key, None, None, str(e)
+    finally:
+        if run_dir and os.path.isdir(run_dir) and not KEEP_OUTPUTS:
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+def run_energy_simulation_from_env(config: Optional[Dict[str, str]] = None) -> Dict[str, object]:
+    bucket = _cfg(config, "S3_BUCKET", S3_BUCKET)
+    idf_prefix = _cfg(config, "S3_IDF_PREFIX", S3_IDF_PREFIX)
+    epw_prefix = _cfg(config, "S3_EPW_PREFIX", S3_EPW_PREFIX)
+    sim_workers = int(_cfg(config, "SIM_WORKERS", str(SIM_WORKERS)))
+
+    c = s3_client(config)
+    epw_index = index_epws_s3(c, bucket, epw_prefix)
+    if not epw_index:
+        raise SystemExit(f"No EPWs under s3://{bucket}/{epw_prefix}")
+
+    idf_objs = [o for o in _list_objects_all(c, bucket, _norm_prefix(idf_prefix)) if o["Key"].lower().endswith(".idf")]
+    if not idf_objs:
+        raise SystemExit(f"No IDFs under s3://{bucket}/{idf_prefix}")
+
+    successes = failures = 0
+    processed: List[str] = []
+
+    # Resolve EPWs and parse filenames up front so only runnable jobs hit the pool.
+    jobs: List[Tuple[str, str]] = []
+    meta: Dict[str, Tuple[str, str, int]] = {}
+    for obj in sorted(idf_objs, key=lambda x: x["Key"]):
+        idf_key = obj["Key"]
+        name = _key_basename(idf_key)
+        try:
+            rcp_dot, aging, year = parse_idf_filename(name)
+        except ValueError as e:
+            failures += 1
+            print(f"[ERROR] {name}: {e}")
+            continue
+        # The filename regexes accept 2020-2084 but the results table only
+        # covers YEARS_START..YEARS_END; reject here so one stray year fails
+        # like a bad filename instead of blowing up staging after the pool.
+        if year < YEARS_START or year > YEARS_END:
+            failures += 1
+            print(f"[ERROR] {name}: Year {year} outside [{YEARS_START}, {YEARS_END}]")
+            continue
+        rcp_nodot = map_rcp_dot_to_nodot(rcp_dot)
+        epw_key = epw_index.get((rcp_nodot, year))
+        if not epw_key:
+            print(f"[WARN] No EPW for {name} → ({rcp_nodot}, {year}); skipping.")
+            failures += 1
+            continue
+        jobs.append((idf_key, epw_key))
+        meta[idf_key] = (rcp_nodot, aging, year)
+
+    cache: _MatrixCache = {}
+    existing_keys = {o["Key"] for o in _list_objects_all(c, bucket, RESULTS_PREFIX)}
+    results: List[Tuple[str, str, int, Optional[float], Optional[float]]] = []
+    if jobs:
+        workers = max(1, min(sim_workers, len(jobs)))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_worker_init, initargs=(config,)) as pool:
+            futures = [
+                pool.submit(_process_one, bucket, idf_key, epw_key, i, len(jobs))
+                for i, (idf_key, epw_key) in enumerate(jobs, start=1)
+            ]
+            for fut in as_completed(futures):
+                idf_key, total_site, per_area, err = fut.result()
+                name = _key_basename(idf_key)
+                if err is not None:
+                    failures += 1
+                    print(f"[ERROR] {name}: {err}")
+                    continue
+                rcp_nodot, aging, year = meta[idf_key]
+                results.append((rcp_nodot, aging, year, total_site, per_area))
+                successes += 1
+                processed.append(idf_key)
+
+    # Batch all staging after the pool finishes: one pass per results key,
+    # sorted by (climate, aging, year) so the emitted column order is stable
+    # across runs. Staging on the main process also means workers never race
+    # on the shared results objects.
+    results.sort(key=lambda r: (r[0], r[1], r[2]))
+    try:
+        for rcp_nodot, aging, year, total_site, _per_area in results:
+            _stage_result(c, cache, existing_keys, bucket, TOTAL_CSV_KEY, rcp_nodot, aging, year, total_site)
+        for rcp_nodot, aging, year, _total_site, per_area in results:
+            _stage_result(c, cache, existing_keys, bucket, PERAREA_CSV_KEY, rcp_nodot, aging, year, per_area)
+    finally:
+        # Flush whatever staged cleanly even if one result raises; a single
+        # bad value must not discard the rest of the run.
+        _flush_cache(c, bucket, cache)
+
+    return {
+        "bucket": bucket,
+        "idf_prefix": idf_prefix.rstrip("/"),
+        "epw_prefix": epw_prefix.rstrip("/"),
+        "results_total_key": TOTAL_XLSX_KEY,
+        "results_per_area_key": PERAREA_XLSX_KEY,
+        "results_total_csv_key": TOTAL_CSV_KEY,
+        "results_per_area_csv_key": PERAREA_CSV_KEY,
+        "processed": processed[:10],
+        "counts": {"success": successes, "failed": failures, "total": len(idf_objs)},
+    }
+
+def main() -> None:
+    print(run_energy_simulation_from_env())
+
+if __name__ == "__main__":
+    main()
+
+# ---------- compatibility alias (fix for adapter name mismatch) ----------
+# Why: some adapters call this legacy name; keep both without duplicating logic.
+run_energy_model_from_env = run_energy_simulation_from_env
@@ -13,10 +13,41 @@ import time
 import uuid
 from typing import Any, Dict
 
+import orjson
 import requests
 from flask import Flask, jsonify, request
+from flask.json.provider import DefaultJSONProvider
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+# One session for all registry traffic: the heartbeat posts every 10-60s and
+# a pooled connection skips DNS + TCP (+ TLS) setup on each beat.
+_SESSION = requests.Session()
+_HTTP_ADAPTER = HTTPAdapter(
+    pool_connections=2, pool_maxsize=2, max_retries=Retry(total=2, backoff_factor=0.2)
+)
+_SESSION.mount("http://", _HTTP_ADAPTER)
+_SESSION.mount("https://", _HTTP_ADAPTER)
+
+class OrjsonProvider(DefaultJSONProvider):
+    # orjson serializes straight to bytes, several times faster than the
+    # stdlib encoder; the status endpoint is polled, so this is a hot path.
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+# Loaded module singleton: repeat create_app() calls (gunicorn --preload,
+# worker recycling) reuse the already-executed module instead of re-importing.
+_MODEL_MODULE: Any = None
 
 def load_simulation_model() -> Any:
+    global _MODEL_MODULE
+    if _MODEL_MODULE is not None:
+        return _MODEL_MODULE
     base_dir = os.path.dirname(__file__)
     file_path = os.path.join(base_dir, "mm_final_energy_sim.py")
     module_name = "mm_final_energy_sim"
@@ -24,9 +55,13 @@ def load_simulation_model() -> Any:
     if spec is None or spec.loader is None:
         raise ImportError(f"Unable to load spec for {file_path}")
     module = importlib.util.module_from_spec(spec)
-    sys.modules[module_name] = module
-    spec.loader.exec_module(module)  # type: ignore[attr-defined]
-    return module
+    # setdefault: if another worker sharing copy-on-write pages already
+    # registered the module, keep that one instead of re-executing.
+    existing = sys.modules.setdefault(module_name, module)
+    if existing is module:
+        spec.loader.exec_module(module)  # type: ignore[attr-defined]
+    _MODEL_MODULE = existing
+    return _MODEL_MODULE
 
 def public_base_url(default_service: str) -> str:
     url = os.getenv("ADAPTER_PUBLIC_URL")
@@ -37,7 +72,8 @@ def public_base_url(default_service: str) -> str:
     return f"http://{host}:{port}"
 
 def _registry_post(url: str, payload: Dict[str, Any], timeout: float = 5.0) -> requests.Response:
-    return requests.post(url, json=payload, timeout=timeout)
+    # data= with pre-encoded orjson bytes skips requests' stdlib json encode.
+    return _SESSION.post(url, data=orjson.dumps(payload), headers=_JSON_HEADERS, timeout=timeout)
 
 def register_with_registry(app_name: str, description: str, endpoints: list[str], logger: logging.Logger) -> None:
     registry = os.getenv("REGISTRY_ENDPOINT")
@@ -50,28 +86,45 @@ def register_with_registry(app_name: str, description: str, endpoints: list[str]
     used_workers = int(os.getenv("MODEL_USED_WORKERS", "0"))
     new_api_url = f"{registry.rstrip('/')}/registry/"
     old_api_url = f"{registry.rstrip('/')}/models/register"
+    new_payload = {
+        "name": app_name, "uri": base_url, "version": version,
+        "max_workers": max_workers, "used_workers": used_workers,
+    }
+    old_payload = {
+        "name": app_name, "description": description, "url": base_url, "endpoints": endpoints,
+    }
+    # Once an API variant succeeds, heartbeats post straight to it instead of
+    # re-walking the new-then-old fallback chain (and its 404) every time.
+    last_good: Dict[str, Any] = {"target": None}
 
     def attempt_once() -> bool:
+        target = last_good["target"]
+        if target is not None:
+            url, payload = target
+            try:
+                r = _registry_post(url, payload)
+                r.raise_for_status()
+                return True
+            except Exception as e:
+                logger.warning("Registration heartbeat to %s failed: %s", url, e)
+                last_good["target"] = None
         try:
-            r = _registry_post(new_api_url, {
-                "name": app_name, "uri": base_url, "version": version,
-                "max_workers": max_workers, "used_workers": used_workers,
-            })
+            r = _registry_post(new_api_url, new_payload)
             if r.status_code == 404:
                 raise FileNotFoundError
             r.raise_for_status()
             logger.info("Registered with registry (new API) at %s", new_api_url)
+            last_good["target"] = (new_api_url, new_payload)
             return True
         except FileNotFoundError:
             pass
         except Exception as e:
             logger.warning("New API registration failed: %s", e)
         try:
-            r = _registry_post(old_api_url, {
-                "name": app_name, "description": description, "url": base_url, "endpoints": endpoints,
-            })
+            r = _registry_post(old_api_url, old_payload)
             r.raise_for_status()
             logger.info("Registered with registry (old API) at %s", old_api_url)
+            last_good["target"] = (old_api_url, old_payload)
             return True
         except Exception as e:
             logger.warning("Old API registration failed: %s", e)
@@ -116,6 +169,7 @@ class SimulationModelAdapter:
                 raise KeyError(f"Run {run_id} does not exist")
             if run["state"] in [RunState.PENDING, RunState.INITIALISED]:
                 run["state"] = RunState.INITIALISED
+                run["config"] = config or {}
             return run
 
     def start_run(self, run_id: str) -> Dict[str, Any]:
@@ -125,24 +179,24 @@ class SimulationModelAdapter:
                 raise KeyError(f"Run {run_id} does not exist")
             if run["state"] in [RunState.RUNNING, RunState.SUCCEEDED, RunState.ERROR]:
                 return run
-            env = os.environ.copy(); env["RUN_ID"] = run_id
+            # No os.environ.copy(): the run's own settings travel in config and
+            # the model falls back to its import-time environment for the rest.
+            config = dict(run["config"]); config["RUN_ID"] = run_id
             run["state"] = RunState.RUNNING
-            t = threading.Thread(target=self._exec_run, args=(run_id, env), daemon=True)
+            t = threading.Thread(target=self._exec_run, args=(run_id, config), daemon=True)
             run["thread"] = t; t.start()
             return run
 
-    def _exec_run(self, run_id: str, env: Dict[str, str]) -> None:
+    def _exec_run(self, run_id: str, config: Dict[str, str]) -> None:
         try:
-            original = os.environ.copy(); os.environ.update(env)
-            try:
-                # DO NOT redirect stdout; let print() flow to Gunicorn/Docker logs
-                fn = getattr(self.model_module, "run_energy_simulation_from_env", None) \
-                     or getattr(self.model_module, "run_energy_model_from_env", None)
-                if fn is None:
-                    raise AttributeError("Neither run_energy_simulation_from_env nor run_energy_model_from_env found")
-                result = fn()
-            finally:
-                os.environ.clear(); os.environ.update(original)
+            # DO NOT redirect stdout; let print() flow to Gunicorn/Docker logs
+            fn = getattr(self.model_module, "run_energy_simulation_from_env", None) \
+                 or getattr(self.model_module, "run_energy_model_from_env", None)
+            if fn is None:
+                raise AttributeError("Neither run_energy_simulation_from_env nor run_energy_model_from_env found")
+            # Pass the per-run settings as config instead of mutating
+            # os.environ, which is process-global and races concurrent runs.
+            result = fn(config=config)
 
             out = result if isinstance(result, dict) else {"message": "Energy simulation completed"}
             with self._lock:
@@ -170,6 +224,7 @@ class SimulationModelAdapter:
 def create_app() -> Flask:
     adapter = SimulationModelAdapter()
     app = Flask(__name__)
+    app.json = OrjsonProvider(app)
     register_with_registry(
         app_name=os.getenv("MODEL_NAME", "energy_sim_model"),
         description=os.getenv("MODEL_DESCRIPTION", "Runs EnergyPlus over IDFs from MinIO and writes XLSX results"),
@@ -180,6 +235,7 @@ def create_app() -> Flask:
             "/model/status/<run_id>",
             "/model/results/<run_id>",
             "/model/remove/<run_id>",
+            "/results/<metric>.xlsx",
         ],
         logger=adapter.logger,
     )
@@ -233,6 +289,26 @@ def create_app() -> Flask:
         adapter.remove_run(run_id)
         return jsonify({"status": "removed", "run_id": run_id})
 
+    @app.get("/results/<metric>.xlsx")
+    def results_xlsx(metric: str):
+        # The run writes CSV; XLSX is materialized here only when asked for.
+        mm = adapter.model_module
+        csv_keys = {
+            "total_site_energy": mm.TOTAL_CSV_KEY,
+            "site_energy_per_area": mm.PERAREA_CSV_KEY,
+        }
+        csv_key = csv_keys.get(metric)
+        if csv_key is None:
+            return jsonify({"error": f"Unknown metric {metric}"}), 404
+        data = mm.results_xlsx_bytes(mm.s3_client(), mm.S3_BUCKET, csv_key)
+        if data is None:
+            return jsonify({"error": f"No results at {csv_key} yet"}), 404
+        return app.response_class(
+            data,
+            mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            headers={"Content-Disposition": f'attachment; filename="results_{metric}.xlsx"'},
+        )
+
     return app
 
 from flask import Flask